@@ -0,0 +1,46 @@
+// Synthetic declarations for trying the generator without the SDK (e.g. on Linux).
+// Properties declare their accessors explicitly as clang-objcgo links them by selector.
+
+typedef signed char BOOL;
+typedef unsigned long NSUInteger;
+typedef double CGFloat;
+typedef struct CGPoint { CGFloat x; CGFloat y; } CGPoint;
+typedef struct CGSize { CGFloat width; CGFloat height; } CGSize;
+typedef struct CGRect { CGPoint origin; CGSize size; } CGRect;
+typedef CGRect NSRect;
+typedef CGPoint NSPoint;
+typedef struct objc_object *id;
+
+@interface NSObject
+- (id)init;
++ (id)new;
+@property (readonly) NSUInteger hash;
+- (NSUInteger)hash;
+@end
+
+@interface NSString : NSObject
+@property (readonly) NSUInteger length;
+- (NSUInteger)length;
++ (NSString*)string;
+@end
+
+@interface NSEnumerator : NSObject
+@property (readonly) NSUInteger count;
+- (NSUInteger)count;
+@end
+
+@interface NSTimeZone : NSObject
+- (id)init __attribute__((unavailable));
+@property (readonly) NSUInteger secondsFromGMT;
+- (NSUInteger)secondsFromGMT;
+@end
+
+@interface NSView : NSObject
+@property NSRect frame;
+- (NSRect)frame;
+- (void)setFrame:(NSRect)frame;
+@property (getter=isOpaque) BOOL opaque;
+- (BOOL)isOpaque;
+- (void)setOpaque:(BOOL)opaque;
+- (void)display;
+@end
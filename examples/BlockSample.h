@@ -0,0 +1,19 @@
+// Synthetic declarations of methods taking blocks, for trying --export-output without the SDK (e.g. on Linux).
+
+typedef signed char BOOL;
+typedef unsigned long NSUInteger;
+typedef struct _NSRange { NSUInteger location; NSUInteger length; } NSRange;
+typedef struct objc_object *id;
+
+@interface NSObject
+- (id)init;
+@end
+
+@interface NSArray : NSObject
+- (NSUInteger)indexOfObjectPassingTest:(BOOL (^)(id obj, NSUInteger idx, BOOL *stop))predicate;
+- (void)enumerateObjectsUsingBlock:(void (^)(id obj, NSUInteger idx, BOOL *stop))block;
+@end
+
+@interface NSIndexSet : NSObject
+- (void)enumerateRangesUsingBlock:(void (^)(NSRange range, BOOL *stop))block;
+@end
@@ -4,8 +4,12 @@
 objcgo: Cgo (Go lang) wrapper interfaces generattor for Objective-C 
 """
 
+import json
+import os
 import re
-from clang.cindex import CursorKind, TypeKind
+import sys
+from StringIO import StringIO
+from clang.cindex import AvailabilityKind, CursorKind, TypeKind, conf
 
 
 def get_node_by_kind(kind, node):
@@ -20,6 +24,21 @@ def filter_node(fn, node):
     return filter(fn, node.get_children())
 
 
+# Returns None for kinds which the bindings do not know (e.g. Objective-C type parameters of newer SDKs).
+def get_type_kind(t):
+    try:
+        return t.kind
+    except ValueError:
+        return None
+
+def get_framework(node):
+    # e.g. /System/Library/Frameworks/AppKit.framework/Headers/NSWindow.h -> AppKit
+    f = node.location.file
+    if not f: return None
+    m = re.search('/(\w+)\.framework/', os.path.normpath(f.name))
+    return m.group(1) if m else None
+
+
 def get_info(node, depth=0):
     children = [get_info(c, depth+1) for c in node.get_children()]
     return { #'id' : get_cursor_id(node),
@@ -33,6 +52,109 @@ def get_info(node, depth=0):
              'children' : children }
 
 
+class Registry:
+    """
+    Packages generated so far, persisted with --registry.
+    The first package provides the runtime (Id, NSObject, ...), and later packages import the packages
+    which already provide the classes they use instead of generating them again.
+    """
+    package = 'sample'
+    import_path = None
+    entries = []               # all packages in the registry file
+    runtime_package = None     # name of the package providing the runtime, None if it is this package
+    provided_classes = {}      # class name -> name of the package providing it
+    imports = {}               # package name -> import path
+    features = []              # optional runtime pieces this package needs
+    runtime_features = set()   # optional runtime pieces emitted by the package providing the runtime
+
+    # option which makes the runtime emit each optional piece
+    feature_options = {
+        'blocks': '--export-output',      # handle table, CCGHandleBox
+        'main-thread': '--main-thread',   # OnMain, CCG_dispatchMain
+    }
+
+    @staticmethod
+    def load(opts):
+        Registry.package = opts.package
+        Registry.import_path = opts.import_path
+        Registry.features = []
+        if opts.export_output: Registry.features.append('blocks')
+        if opts.main_thread: Registry.features.append('main-thread')
+        Registry.runtime_features = set()
+        Registry.entries = []
+        Registry.runtime_package = None
+        Registry.provided_classes = {}
+        Registry.imports = {}
+
+        if not opts.registry or not os.path.exists(opts.registry): return
+
+        f = open(opts.registry)
+        Registry.entries = json.load(f)['packages']
+        f.close()
+
+        # a package only uses packages registered before it, so regenerating the base package does not depend on others
+        paths = map(lambda x:x['import_path'], Registry.entries)
+        providers = Registry.entries[:paths.index(opts.import_path)] if opts.import_path in paths else Registry.entries
+
+        for p in providers:
+            name = str(p['package'])
+            if p.get('runtime'):
+                Registry.runtime_package = name
+                Registry.runtime_features = set(map(str, p.get('features', [])))
+            Registry.imports[name] = str(p['import_path'])
+            for c in p['classes']:
+                Registry.provided_classes.setdefault(str(c), name)
+
+    @staticmethod
+    def dump(classes):
+        entry = {
+            'package': Registry.package,
+            'import_path': Registry.import_path,
+            'runtime': Registry.is_base(),
+            'features': Registry.features,
+            'classes': sorted(classes),
+        }
+        paths = map(lambda x:x['import_path'], Registry.entries)
+        entries = list(Registry.entries)
+        if Registry.import_path in paths:
+            entries[paths.index(Registry.import_path)] = entry
+        else:
+            entries.append(entry)
+        return json.dumps({'packages': entries}, indent=2, sort_keys=True) + '\n'
+
+    # Returns an error message if this package needs a runtime piece which the runtime package does not have.
+    @staticmethod
+    def check_features():
+        if Registry.is_base(): return None
+        missing = filter(lambda x:not x in Registry.runtime_features, Registry.features)
+        if not missing: return None
+        options = ' and '.join(map(lambda x:Registry.feature_options[x], missing))
+        return 'the runtime package %s was generated without %s' % (Registry.runtime_package, options)
+
+    @staticmethod
+    def is_base():
+        return not Registry.runtime_package
+
+    # qualifies a Go name of the runtime (e.g. Id -> sample.Id)
+    @staticmethod
+    def runtime_name(name):
+        if Registry.is_base(): return name
+        return Registry.runtime_package + '.' + name
+
+    @staticmethod
+    def class_name(name):
+        if not name in Registry.provided_classes: return name
+        return Registry.provided_classes[name] + '.' + name
+
+    # packages imported by a dependent package
+    @staticmethod
+    def used_packages(used_classes):
+        if Registry.is_base(): return []
+        ps = set([Registry.runtime_package])
+        ps.update(map(lambda x:Registry.provided_classes[x], filter(lambda x:x in Registry.provided_classes, used_classes)))
+        return sorted(ps)
+
+
 class Typename:
     cgo_unacceptable = None
 
@@ -44,6 +166,9 @@ class Typename:
 
     @staticmethod
     def new(node):
+        # The children of a block parameter are the types of the block's parameters, so check this first.
+        if get_type_kind(node.type) == TypeKind.BLOCKPOINTER: return BlockType(node.type)
+
         cref = get_node_by_kind(CursorKind.OBJC_CLASS_REF, node)
         tref = get_node_by_kind(CursorKind.TYPE_REF, node)
 
@@ -101,6 +226,23 @@ class Typename:
         #print enc, node.displayname
         return InvalidType()
 
+    # Creates a typename from a clang type instead of a cursor (e.g. parameters of a block type).
+    @staticmethod
+    def from_type(t):
+        kind = get_type_kind(t)
+        # e.g. ObjectType of generic classes, or types with nullability attributes
+        if kind is None or kind.name in ('OBJCTYPEPARAM', 'ATTRIBUTED'): return InvalidType()
+        if kind == TypeKind.VOID: return VoidType()
+        if kind == TypeKind.OBJCID: return CType('id', False)
+        if kind == TypeKind.OBJCOBJECTPOINTER:
+            p = t.get_pointee()
+            if get_type_kind(p) == TypeKind.OBJCINTERFACE: return ObjcClassType(p.spelling)
+            return CType('id', False) # id<Protocol>
+        if kind == TypeKind.POINTER:
+            p = t.get_pointee()
+            return CType(re.sub('^const ', '', p.spelling) + '*', p.is_const_qualified())
+        return CType(re.sub('^const ', '', t.spelling), t.is_const_qualified())
+
     @property
     def is_cgo_acceptable(self):
         return not Typename.is_reject(self._raw)
@@ -114,7 +256,6 @@ class Typename:
                 'SEL',
                 'IMP', 
                 'Class',
-                'CGFloat',
                 'AEDesc',
                 'AppleEvent',
                 'AEEventID',
@@ -122,7 +263,6 @@ class Typename:
                 'NSAppleEventManagerSuspensionID',
                 'NSMethodSignature', 
                 'NSInvocation',
-                'NSRange',
                 'NSInteger',
                 #'NSUInteger',
                 #'BOOL',
@@ -159,9 +299,17 @@ class Typename:
     def objc_class(self):
         return False
 
+    @property
+    def is_block(self):
+        return False
+
+    # Go expression converting a value returned from C into the Go type of this typename.
     def box_value_go(self, value):
-        #return ret_type + '_' + '(Id(C.' + clazz.raw + '_' + self.name.to_c() + '(' +  args_str + ')))'
-        pass
+        return '(' + value + ')'
+
+    # Go expression converting a Go value of this typename into the argument of a C function.
+    def unbox_value_go(self, value):
+        return value
 
     def to_return_c(self): #FIXME
         return self.to_param_c()
@@ -176,6 +324,23 @@ class Typename:
         if not with_package: return r
         return r # FIXME
 
+    # Go spelling of the C type, as used in the signatures of exported Go functions.
+    def to_cgo(self):
+        return 'C.' + self._raw
+
+    # Go type in the signatures of Go funcs passed as blocks, None if it has no type usable by other packages.
+    # cgo types belong to the package declaring them, so no other package could write a func literal of them.
+    def to_callback_go(self):
+        return self.to_go()
+
+    # Go expression converting a value passed from a block (see to_cgo()) into to_callback_go()
+    def box_callback_go(self, value):
+        return self.box_value_go(value)
+
+    # Go expression converting a value returned by a Go func into to_cgo()
+    def unbox_callback_go(self, value):
+        return self.unbox_value_go(value)
+
 class InvalidType(Typename):
     def __init__(self):
         Typename.__init__(self, '*INVALID TYPE*')
@@ -231,13 +396,50 @@ class CType(Typename):
         'unsigned long long': 'C.ulonglong',
 
         'char*': 'string',
+        'BOOL*': '*C.BOOL',
+        'CGFloat': 'CGFloat',
         'NSRect': 'NSRect',
         'NSPoint': 'NSPoint',
+        'NSSize': 'NSSize',
+        'NSRange': 'NSRange',
         'NSUInteger': 'C.uint',
 
         'NSBackingStoreType': 'C.NSBackingStoreType'
     }
 
+    # plain Go types of values passed to and returned from Go funcs of blocks
+    callback_type_map = {
+        'void*': 'unsafe.Pointer',
+        'bool': 'bool',
+        'BOOL': 'bool',
+        'BOOL*': '*bool',
+
+        'float': 'float32',
+        'double': 'float64',
+
+        'char': 'int8',
+        'short': 'int16',
+        'int': 'int32',
+        'long': 'int64',
+        'long long': 'int64',
+
+        'unsigned char': 'uint8',
+        'unsigned short': 'uint16',
+        'unsigned int': 'uint32',
+        'unsigned long': 'uint64',
+        'unsigned long long': 'uint64',
+        'NSUInteger': 'uint64',
+    }
+
+    # types which have a boxing function (e.g. NSRect_) in the runtime
+    boxed_types = set(['id', 'NSRect', 'NSPoint', 'NSSize', 'NSRange'])
+
+    # types defined in the Go runtime
+    runtime_types = set(['id', 'CGFloat', 'NSRect', 'NSPoint', 'NSSize', 'NSRange'])
+
+    # Go structs of the runtime which have the same memory layout as the C structs
+    layout_compatible_types = set(['NSRect', 'NSPoint', 'NSSize', 'NSRange'])
+
     def __init__(self, raw, is_const):
         Typename.__init__(self, raw)
         self.is_const = is_const
@@ -247,8 +449,20 @@ class CType(Typename):
         return (not Typename.is_reject(self.raw)) and (self.raw in set(CType.go_type_map.keys()) or self.raw in Enum.declared_enumtypes or Typedef.get(self.raw))
 
     def box_value_go(self, value):
-        #return ret_type + '_' + '(Id(C.' + clazz.raw + '_' + self.name.to_c() + '(' +  args_str + ')))'
-        pass
+        if self.raw == 'char*': return 'C.GoString(' + value + ')'
+        if self.raw == 'CGFloat': return self.to_go() + '(' + value + ')'
+        # NSRect_ and so on take C types, which are local to a package, so they are generated in every package
+        if self.raw in CType.layout_compatible_types: return self.raw + '_(' + value + ')'
+        if self.raw in CType.boxed_types: return self.to_go() + '_(' + value + ')'
+        return '(' + value + ')'
+
+    def unbox_value_go(self, value):
+        if self.raw == 'id': return 'unsafe.Pointer(' + value + ')'
+        if self.raw == 'char*': return 'C.CString(' + value + ')'
+        if self.raw == 'CGFloat': return 'C.CGFloat(' + value + ')'
+        # reinterpret in place; value must be addressable
+        if self.raw in CType.layout_compatible_types: return '*(*C.%s)(unsafe.Pointer(&%s))' % (self.raw, value)
+        return value
 
     def to_param_c(self):
         type_map = {
@@ -264,11 +478,36 @@ class CType(Typename):
 
     def to_go(self):
         r = self._raw
+        if r in CType.runtime_types:
+            return Registry.runtime_name(CType.go_type_map[r])
         if r in CType.go_type_map:
             return CType.go_type_map[r]
 
         return 'C.' + r
 
+    def to_callback_go(self):
+        if self.raw in CType.runtime_types: return self.to_go()
+        if self.raw in CType.callback_type_map: return CType.callback_type_map[self.raw]
+        return None
+
+    def box_callback_go(self, value):
+        if self.raw in CType.runtime_types: return self.box_value_go(value)
+        # BOOL is passed as C bool, and a Go bool has the same size as BOOL
+        if self.raw == 'BOOL*': return '(*bool)(unsafe.Pointer(' + value + '))'
+        return self.to_callback_go() + '(' + value + ')'
+
+    def unbox_callback_go(self, value):
+        if self.raw in CType.runtime_types: return self.unbox_value_go(value)
+        if self.raw == 'BOOL*': return '(*C.BOOL)(unsafe.Pointer(' + value + '))'
+        return self.to_cgo() + '(' + value + ')'
+
+    def to_cgo(self):
+        if self.raw in set(['id', 'void*']): return 'unsafe.Pointer'
+        if self.raw == 'char*': return '*C.char'
+        r = self.to_go()
+        if r.startswith('C.') or r.startswith('*C.'): return r
+        return 'C.' + self.raw
+
 class ObjcClassType(Typename):
     used_classes = set()
 
@@ -289,6 +528,117 @@ class ObjcClassType(Typename):
     def to_param_c(self):
         return 'void*' 
 
+    def to_go(self):
+        return Registry.class_name(self.raw)
+
+    def box_value_go(self, value):
+        return self.to_go() + '_(' + Registry.runtime_name('Id') + '(' + value + '))'
+
+    def unbox_value_go(self, value):
+        return value + '.Self()'
+
+    def to_cgo(self):
+        return 'unsafe.Pointer'
+
+
+class BlockType(Typename):
+    # accept block parameters; set when Go callbacks are exported (see --export-output)
+    enabled = False
+    # trampoline name -> BlockType of block parameters which are acceptable
+    used_signatures = {}
+
+    def __init__(self, t):
+        Typename.__init__(self, t.spelling)
+
+        # The prototype is not inspected unless blocks are accepted, so that it can not break other runs.
+        if not BlockType.enabled:
+            self.result = InvalidType()
+            self.args = []
+            self.result_c = 'void'
+            self.args_c = []
+            return
+
+        proto = t.get_pointee()
+        try:
+            arg_types = list(proto.argument_types())
+        except ValueError:
+            # the bindings check the kind of each argument while iterating
+            arg_types = None
+        self.result = Typename.from_type(proto.get_result())
+        self.args   = map(Typename.from_type, arg_types) if arg_types is not None else [InvalidType()]
+
+        # spellings for block literals in Objective-C
+        # The input is parsed with -fobjc-arc, but the generated code is not compiled with ARC.
+        strip_ownership = lambda x:re.sub('\s*__(strong|weak|autoreleasing|unsafe_unretained)\s*', ' ', x.spelling).strip()
+        self.result_c = strip_ownership(proto.get_result())
+        self.args_c   = map(strip_ownership, arg_types or [])
+
+        if self.is_cgo_acceptable:
+            BlockType.used_signatures[self.trampoline_name()] = self
+
+    @property
+    def is_block(self):
+        return True
+
+    @property
+    def is_cgo_acceptable(self):
+        if not BlockType.enabled: return False
+        if not self.result.is_cgo_acceptable: return False
+        if not self.result.is_void and not self.result.to_callback_go(): return False
+        return all(map(lambda x:x.is_cgo_acceptable and not x.is_void and x.to_callback_go(), self.args))
+
+    # blocks are passed to C as handles of Go funcs
+    def to_param_c(self):
+        return 'uintptr_t'
+
+    def to_go(self):
+        r = 'func(' + ', '.join(map(lambda x:x.to_callback_go(), self.args)) + ')'
+        if not self.result.is_void: r += ' ' + self.result.to_callback_go()
+        return r
+
+    def unbox_value_go(self, value):
+        return 'C.uintptr_t(' + Registry.runtime_name('NewHandle') + '(' + value + '))'
+
+    # e.g. BOOL (^)(id, NSUInteger, BOOL *) -> CCG_block_bool_Id_uint_pBOOL
+    def trampoline_name(self):
+        def mangle(t):
+            if t.is_void: return 'void'
+            # package qualifiers (C., sample.) are dropped so that names do not depend on the registry
+            return re.sub('\W', '', re.sub('\w+\.', '', t.to_go()).replace('*', 'p'))
+        # exported names are global, so trampolines of dependent packages are prefixed with the package name
+        prefix = 'CCG_block_' if Registry.is_base() else 'CCG_' + Registry.package + '_block_'
+        return prefix + '_'.join(map(mangle, [self.result] + self.args))
+
+    # block literal which calls the trampoline with the handle
+    # The block captures 'ccg_<handle>_box' so that the handle is released when the block is released.
+    def to_block_literal_c(self, handle):
+        indices = range(len(self.args_c))
+        params = ', '.join(map(lambda i:self.args_c[i] + ' ccg_a%d' % i, indices)) or 'void'
+        call = self.trampoline_name() + '(' + ', '.join([handle] + map(lambda i:'ccg_a%d' % i, indices)) + ')'
+        body = (call if self.result.is_void else 'return ' + call) + ';'
+        return '^' + self.result_c + '(' + params + ') { (void)ccg_' + handle + '_box; ' + body + ' }'
+
+    def compile_extern_c(self):
+        params = ['uintptr_t h'] + map(lambda i:self.args[i].to_param_c() + ' a%d' % i, range(len(self.args)))
+        return 'extern ' + self.result.to_return_c() + ' ' + self.trampoline_name() + '(' + ', '.join(params) + ');'
+
+    def compile_export_go(self):
+        name = self.trampoline_name()
+        indices = range(len(self.args))
+        params = ['h C.uintptr_t'] + map(lambda i:'a%d ' % i + self.args[i].to_cgo(), indices)
+        args = map(lambda i:self.args[i].box_callback_go('a%d' % i), indices)
+
+        s = ['//export ' + name]
+        s.append('func ' + name + '(' + ', '.join(params) + ') ' + ('' if self.result.is_void else self.result.to_cgo()) + ' {')
+        s.append('  f := ' + Registry.runtime_name('LookupHandle') + '(uintptr(h)).(' + self.to_go() + ')')
+        if self.result.is_void:
+            s.append('  f(' + ', '.join(args) + ')')
+        else:
+            s.append('  r := f(' + ', '.join(args) + ')')
+            s.append('  return ' + self.result.unbox_callback_go('r'))
+        s.append('}')
+        return '\n'.join(s)
+
 
 class Identifier:
     def __init__(self, raw):
@@ -317,6 +667,25 @@ class MethodName(Identifier):
         r = self._to_camel
         return r[0].upper() + r[1:]
 
+class FieldName(Identifier):
+    go_keywords = set([
+        'break', 'case', 'chan', 'const', 'continue', 'default', 'defer', 'else', 'fallthrough', 'for', 'func',
+        'go', 'goto', 'if', 'import', 'interface', 'map', 'package', 'range', 'return', 'select', 'struct',
+        'switch', 'type', 'var',
+    ])
+
+    def __init__(self, raw):
+        Identifier.__init__(self, raw)
+
+    def to_c(self):
+        return self._raw
+
+    # cgo prefixes C struct fields named after Go keywords with '_'
+    def to_cgo(self):
+        r = self._raw
+        if r in FieldName.go_keywords: return '_' + r
+        return r
+
 class ParamName(Identifier):
     def __init__(self, raw):
         assert(not ':' in raw)
@@ -347,6 +716,31 @@ class Base:
 class Interface(Base):
     declared_classes = set()
 
+    # frameworks whose classes are only usable on the main thread
+    main_thread_frameworks = set(['AppKit'])
+
+    # emit Snapshot()/SetSnapshot() to read and write all properties in one cgo call
+    emit_snapshots = False
+
+    # classes whose default-constructed instances can not be used in benchmarks (e.g. abstract classes)
+    unbenchmarkable_classes = set([
+        'NSCoder',
+        'NSDirectoryEnumerator',
+        'NSEnumerator',
+        'NSExpression',
+        'NSFileHandle',
+        'NSFormatter',
+        'NSInputStream',
+        'NSNotification',
+        'NSOutputStream',
+        'NSPort',
+        'NSPredicate',
+        'NSProxy',
+        'NSScanner',
+        'NSStream',
+        'NSValue',
+    ])
+
     def __init__(self, node):
         def self_typename(self):
             # If current node is a OBJC_CATEGORY_DECL, the displayname of the node is a category name.
@@ -372,6 +766,7 @@ class Interface(Base):
         Base.__init__(self, node)
         self.typename       = self_typename(self)
         self.super_typename = super_typename(self)
+        self.framework      = get_framework(node)
 
         # return if deprecated class
         if not self.typename: return
@@ -380,6 +775,11 @@ class Interface(Base):
         self.methods       = map(bind(InstanceMethod, self.typename), filter_kind(CursorKind.OBJC_INSTANCE_METHOD_DECL, node))
         self.class_methods = map(bind(ClassMethod   , self.typename), filter_kind(CursorKind.OBJC_CLASS_METHOD_DECL, node))
 
+        # force remove 'init' from NSObject
+        # This is done here rather than in compile_c() so that emitting an interface never mutates the model.
+        if self.typename.raw == 'NSObject':
+            self.methods = filter(lambda x: x.name.raw != 'init', self.methods)
+
         map(lambda x:self.link_accessors(x), self.props)
 
         Interface.declared_classes.add(self.typename.raw)
@@ -391,8 +791,8 @@ class Interface(Base):
         def get_setter_selector(name):
             return 'set' + name[0].upper() + name[1:] + ':'
 
-        getters = filter(lambda x: prop.name.raw == x.name.raw, self.methods)
-        setters = filter(lambda x: prop.name.to_setter_selector() == x.name.raw, self.methods)
+        getters = filter(lambda x: prop.getter_selector == x.name.raw, self.methods)
+        setters = filter(lambda x: prop.setter_selector == x.name.raw, self.methods)
 
         assert(len(getters) <= 1)
         assert(len(setters) <= 1)
@@ -400,26 +800,42 @@ class Interface(Base):
         if getters: getters[0].set_as_getter(prop)
         if setters: setters[0].set_as_setter(prop)
 
+    @property
+    def is_main_thread_only(self):
+        return self.framework in Interface.main_thread_frameworks
+
+    def _on_main(self):
+        return Method.route_main_thread and self.is_main_thread_only
+
+    # wraps C statements to run on the main thread if needed
+    def _on_main_c(self, stmts):
+        if not self._on_main(): return stmts
+        return ['  CCG_onMain(^{'] + map(lambda x:'  ' + x, stmts) + ['  });']
+
     def compile_c(self):
         if not self.typename.is_cgo_acceptable: return '\n// ' + self.typename.raw + '\n'
 
         s = ['', '////' + self.typename.raw]
 
-        # force remove 'init' from NSObject
-        if self.typename.raw == 'NSObject':
-            self.methods = filter(lambda x: x.name.raw != 'init', self.methods)
-
         # output init (default ctor)
         init = filter(lambda x: x.name.raw == 'init', self.methods)
         assert(len(init) <= 1)
         if len(init) == 0:
             s.append('void* ' + self.typename.raw + '_init() {')
-            s.append('  return [[' + self.typename.raw + ' alloc] init];')
+            if self._on_main():
+                s.append('  __block void* ccg_ret;')
+                s.append('  CCG_onMain(^{ ccg_ret = [[' + self.typename.raw + ' alloc] init]; });')
+                s.append('  return ccg_ret;')
+            else:
+                s.append('  return [[' + self.typename.raw + ' alloc] init];')
             s.append('}')
 
         # output other methods
         s.append('\n'.join(map(lambda x:x.compile_c(), self.methods)))
         s.append('\n'.join(map(lambda x:x.compile_c(), self.class_methods)))
+
+        if Interface.emit_snapshots and self._snapshot_accessors()[0]:
+            s.append(self.compile_snapshot_c())
         return '\n'.join(s)
 
     def compile_go(self):
@@ -430,13 +846,13 @@ class Interface(Base):
         # output struct
         s.append('type ' + self.typename.raw + ' struct {')
         if self.super_typename:
-            s.append('  ' + self.super_typename.raw)
+            s.append('  ' + self.super_typename.to_go())
         else:
-            s.append('  self Id')
+            s.append('  self ' + Registry.runtime_name('Id'))
         s.append('}')
 
         # output boxing method
-        s.append('func ' + self.typename.raw + '_(i Id) ' + self.typename.raw + ' {')
+        s.append('func ' + self.typename.raw + '_(i ' + Registry.runtime_name('Id') + ') ' + self.typename.raw + ' {')
         if self.super_typename:
             s.append('  return ' + self.typename.raw + '{ ' + self.super_typename.to_go() + '_(i) }')
         elif self.typename.raw == 'NSObject':
@@ -450,7 +866,7 @@ class Interface(Base):
         assert(len(init) <= 1)
         if len(init) == 0:
             s.append('func ' + self.typename.raw + '_init() ' + self.typename.raw + ' {')
-            s.append('  p := ' + 'Id(C.' + self.typename.raw + '_init())')
+            s.append('  p := ' + Registry.runtime_name('Id') + '(C.' + self.typename.raw + '_init())')
             s.append('  return ' + self.typename.raw + '_(p)')
             s.append('}')
 
@@ -458,6 +874,87 @@ class Interface(Base):
         s.append('\n'.join(map(lambda x:x.compile_go(), self.methods)))
         s.append('\n'.join(map(lambda x:x.compile_go(), self.class_methods)))
 
+        if Interface.emit_snapshots and self._snapshot_accessors()[0]:
+            s.append(self.compile_snapshot_go())
+
+        return '\n'.join(s)
+
+    # getters and setters of properties which are batched into a snapshot
+    def _snapshot_accessors(self):
+        getters = filter(lambda x:x.is_getter and not x.is_static and x.is_cgo_acceptable, self.methods)
+        names = set(map(lambda x:x.prop.name.raw, getters))
+        setters = filter(lambda x:x.is_setter and not x.is_static and x.is_cgo_acceptable and x.prop.name.raw in names, self.methods)
+        return (getters, setters)
+
+    def compile_snapshot_c(self):
+        (getters, setters) = self._snapshot_accessors()
+        clazz = self.typename.raw
+        snapshot = 'CCG_' + clazz + '_snapshot'
+
+        s = ['typedef struct {']
+        s.extend(map(lambda x:'  ' + x.return_typename.to_return_c() + ' ' + FieldName(x.prop.name.raw).to_c() + ';', getters))
+        s.append('} ' + snapshot + ';')
+
+        s.append('void CCG_' + clazz + '_getSnapshot(void* goobj, ' + snapshot + '* s) {')
+        s.extend(self._on_main_c(map(lambda g:'  s->' + FieldName(g.prop.name.raw).to_c() + ' = [(' + clazz + '*)goobj ' + g.name.raw + '];', getters)))
+        s.append('}')
+
+        if setters:
+            s.append('void CCG_' + clazz + '_setSnapshot(void* goobj, ' + snapshot + '* s) {')
+            stmts = []
+            for x in setters:
+                value = 's->' + FieldName(x.prop.name.raw).to_c()
+                if x.prop.typename.objc_class: value = '(' + x.prop.typename.raw + '*)' + value
+                stmts.append('  [(' + clazz + '*)goobj ' + x.name.raw + value + '];')
+            s.extend(self._on_main_c(stmts))
+            s.append('}')
+
+        return '\n'.join(s)
+
+    def compile_snapshot_go(self):
+        (getters, setters) = self._snapshot_accessors()
+        clazz = self.typename.raw
+        fields = dict(map(lambda x:(x.prop.name.raw, x._funcname_go()), getters))
+
+        s = ['type ' + clazz + 'Snapshot struct {']
+        s.extend(map(lambda x:'  ' + x._funcname_go() + ' ' + x.return_typename.to_go(), getters))
+        s.append('}')
+
+        s.append('func (goobj ' + clazz + ') Snapshot() ' + clazz + 'Snapshot {')
+        s.append('  var s C.CCG_' + clazz + '_snapshot')
+        s.append('  C.CCG_' + clazz + '_getSnapshot(goobj.Self(), &s)')
+        s.append('  return ' + clazz + 'Snapshot{')
+        for g in getters:
+            s.append('    ' + g._funcname_go() + ': ' + g.return_typename.box_value_go('s.' + FieldName(g.prop.name.raw).to_cgo()) + ',')
+        s.append('  }')
+        s.append('}')
+
+        # only readwrite properties are written back
+        if setters:
+            s.append('func (goobj ' + clazz + ') SetSnapshot(v ' + clazz + 'Snapshot) {')
+            s.append('  var s C.CCG_' + clazz + '_snapshot')
+            for x in setters:
+                s.append('  s.' + FieldName(x.prop.name.raw).to_cgo() + ' = ' + x.prop.typename.unbox_value_go('v.' + fields[x.prop.name.raw]))
+            s.append('  C.CCG_' + clazz + '_setSnapshot(goobj.Self(), &s)')
+            s.append('}')
+
+        return '\n'.join(s)
+
+    def compile_bench_go(self):
+        if not self.typename.is_cgo_acceptable or self.is_main_thread_only: return ''
+        if self.typename.raw in Interface.unbenchmarkable_classes: return ''
+
+        # Constructors and class methods are not benchmarked since objects created in each iteration are never released.
+        # Getters are called on one object, which is created before the timer starts.
+        # an exception raised by init (e.g. NS_UNAVAILABLE) would abort all benchmarks
+        init = filter(lambda x: x.name.raw == 'init', self.methods)
+        if init and (not init[0].is_cgo_acceptable or init[0].node.availability == AvailabilityKind.NOT_AVAILABLE): return ''
+
+        ctor = self.typename.raw + '_init'
+        s = []
+        for m in filter(lambda x:x.is_benchmark_safe, self.methods):
+            s.append(compile_benchmark_go(self.typename.raw + '_' + m._funcname_go(), ['obj := ' + ctor + '()'], 'obj.' + m._funcname_go() + '()', True))
+
         return '\n'.join(s)
 
 
@@ -468,6 +965,16 @@ class Property(Base): # FIXME
         self.name = PropName(self.node.displayname)
         assert(self.typename)
 
+        # selectors of the accessors, which getter= and setter= may rename (e.g. @property (getter=isVisible) BOOL visible)
+        self.getter_selector = self.name.raw
+        self.setter_selector = self.name.to_setter_selector()
+        tokens = map(lambda x:x.spelling, self.node.get_tokens())
+        if ')' in tokens: tokens = tokens[:tokens.index(')')]
+        for i in range(len(tokens) - 2):
+            if tokens[i+1] != '=': continue
+            if tokens[i] == 'getter': self.getter_selector = tokens[i+2]
+            if tokens[i] == 'setter': self.setter_selector = tokens[i+2] + ':'
+
     def __repr__(self):
         p = '*' if self.node.type.kind == TypeKind.OBJCOBJECTPOINTER else ''
         return self.typename + p + ' ' + self.name
@@ -494,26 +1001,19 @@ class Method(Base):
         # un-compilable
         'NSURLSessionConfiguration_isDiscretionary',
         # black
-        'NSEvent__addLocalMonitorForEventsMatchingMaskHandler',
         'NSExpression_expressionBlock',
-        'NSArray_indexOfObjectPassingTest',
-        'NSArray_indexesOfObjectsPassingTest',
-        'NSDictionary_keysOfEntriesPassingTest',
-        'NSFileManager_enumeratorAtURLIncludingPropertiesForKeysOptionsErrorHandler',
-        'NSIndexSet_indexPassingTest',
-        'NSIndexSet_indexesPassingTest',
-        'NSOrderedSet_indexOfObjectPassingTest',
-        'NSOrderedSet_indexesOfObjectsPassingTest',
-        'NSSet_objectsPassingTest',
-        'NSPredicate__predicateWithBlock',
     ])
 
+    # run methods of main-thread-only frameworks on the main thread (see --main-thread)
+    route_main_thread = False
+
     def __init__(self, node, class_typename, is_static):
         Base.__init__(self, node)
         self.name = MethodName(self.node.displayname)
         self.return_typename = Typename.new(self.node)
         self.class_typename = class_typename
         self.is_static = is_static
+        self.framework = get_framework(node)
 
         # if return_typename is InvalidType, we change it to VoidType
         if isinstance(self.return_typename, InvalidType):
@@ -540,17 +1040,29 @@ class Method(Base):
 
         if any(map(lambda x:not x.typename.is_cgo_acceptable, self.params)): return False
         if self.is_ctor: return True # FIXME: force True
+        if self.return_typename.is_block: return False # blocks can be passed to, but not returned from Objective-C
             
         return self.return_typename.is_cgo_acceptable
 
     def get_cgo_rejected_reason(self):
         if self._funcname_c() in Method.unacceptalble_methods: return 'unacceptalble-method'
 
-        rejected = [] if self.return_typename.is_cgo_acceptable else [self.return_typename]
+        rejected = [] if self.return_typename.is_cgo_acceptable and not self.return_typename.is_block else [self.return_typename]
         rejected.extend(map(lambda x:x.name, filter(lambda x:not x.typename.is_cgo_acceptable, self.params)))
 
         return 'REJECT: ' + ' '.join(map(lambda x:str(x), rejected))
 
+    @property
+    def is_main_thread_only(self):
+        # check the method's own header since categories may add methods of another framework
+        return self.framework in Interface.main_thread_frameworks
+
+    @property
+    def is_benchmark_safe(self):
+        # only argument-free getters of instances are benchmarked
+        if not self.is_cgo_acceptable or self.is_ctor or self.is_static or len(self.params) > 0: return False
+        return self.is_getter
+
     def set_as_getter(self, prop):
         assert(len(self.params) == 0)
         self.is_getter = True
@@ -568,6 +1080,12 @@ class Method(Base):
     def _funcname_c(self):
         return self.class_typename.raw + ('__' if self.is_static else '_') + self.name.to_c()
 
+    def _funcname_go(self):
+        funcname = self.name.to_go()
+        if self.is_ctor or self.is_static:
+            funcname = self.class_typename.raw + '_' + funcname[0].lower() + funcname[1:]
+        return funcname
+
     def compile_c(self):
         is_static = self.is_ctor or self.is_static
 
@@ -586,20 +1104,32 @@ class Method(Base):
 
         s.append(self.return_typename.to_return_c() + ' ' + self._funcname_c() + '(' + params_str + ') {')
         if self.is_static:
+            if self.is_ctor: raise 'foobar'
+            message = '[' + self.class_typename.raw + ' ' + args_str + ']'
+        else:
             if self.is_ctor:
-                s.append('  return [' + self.class_typename.raw + ' ' + args_str + '];')
-                raise 'foobar'
-            elif not self.return_typename.is_void:
-                s.append('  return [' + self.class_typename.raw + ' ' + args_str + '];')
+                message = '[[' + self.class_typename.raw + ' alloc] ' + args_str + ']'
             else:
-                s.append('  [' + self.class_typename.raw + ' ' + args_str + '];')
+                message = '[(' + self.class_typename.raw + '*)goobj ' + args_str + ']'
+        returns = self.is_ctor or not self.return_typename.is_void
+
+        blocks = map(lambda x:x.name.to_c(), filter(lambda x:x.typename.is_block, self.params))
+        on_main = Method.route_main_thread and self.is_main_thread_only
+        if not blocks and not on_main:
+            s.append('  ' + ('return ' if returns else '') + message + ';')
         else:
-            if self.is_ctor:
-                s.append('  return [[' + self.class_typename.raw + ' alloc] ' + args_str + '];')
-            elif not self.return_typename.is_void:
-                s.append('  return [(' + self.class_typename.raw + '*)goobj ' + args_str + '];')
+            # Each block retains a box of its handle when it is copied, so the handle lives as long as the block.
+            # Locals are prefixed with 'ccg_' so that they do not clash with parameters.
+            for b in blocks:
+                s.append('  CCGHandleBox* ccg_' + b + '_box = [[CCGHandleBox alloc] initWithHandle:' + b + '];')
+            if on_main:
+                if returns: s.append('  __block ' + self.return_typename.to_return_c() + ' ccg_ret;')
+                s.append('  CCG_onMain(^{ ' + ('ccg_ret = ' if returns else '') + message + '; });')
             else:
-                s.append('  [(' + self.class_typename.raw + '*)goobj ' + args_str + '];')
+                s.append('  ' + (self.return_typename.to_return_c() + ' ccg_ret = ' if returns else '') + message + ';')
+            for b in blocks:
+                s.append('  [ccg_' + b + '_box release];')
+            if returns: s.append('  return ccg_ret;')
 
         s.append('}')
 
@@ -619,32 +1149,20 @@ class Method(Base):
         args_str = ', '.join(args)
 
         instance = '' if is_static else '(goobj ' + self.class_typename.to_go() + ') '
-        funcname = self.name.to_go()
-        if is_static:
-            funcname = self.class_typename.raw + '_' + funcname[0].lower() + funcname[1:]
+        funcname = self._funcname_go()
         s = ['func ' + instance + funcname + '(' + params_str + ') ' + ret_type + ' {']
 
+        call = 'C.' + self._funcname_c() + '(' +  args_str + ')'
         if self.is_static:
             if self.return_typename.is_void:
-                s.append('  C.' + self._funcname_c() + '(' +  args_str + ')')
-            elif self.return_typename.objc_class:
-                s.append('  return ' + ret_type + '_(Id(C.' + self._funcname_c() + '(' +  args_str + ')))')
-            elif ret_type == 'NSRect' or ret_type == 'NSPoint' or ret_type == 'Id':
-                s.append('  return ' + ret_type + '_(C.' + self._funcname_c() + '(' +  args_str + '))')
+                s.append('  ' + call)
             else:
-                s.append('  return ' + '(C.' + self._funcname_c() + '(' +  args_str + '))')
+                s.append('  return ' + self.return_typename.box_value_go(call))
         else:
             if self.is_ctor or not self.return_typename.is_void or self.is_getter:
-                if self.return_typename.objc_class:
-                    s.append('  return ' + ret_type + '_' + '(Id(C.' + self._funcname_c() + '(' +  args_str + ')))')
-                elif self.return_typename.raw == 'char*':
-                    s.append('  return C.GoString(C.' + self._funcname_c() + '(' +  args_str + '))')
-                elif ret_type == 'NSRect' or ret_type == 'NSPoint' or ret_type == 'Id':
-                    s.append('  return ' + ret_type + '_(C.' + self._funcname_c() + '(' +  args_str + '))')
-                else:
-                    s.append('  return ' + '(C.' + self._funcname_c() + '(' +  args_str + '))')
+                s.append('  return ' + self.return_typename.box_value_go(call))
             else:
-                s.append('  C.' + self._funcname_c() + '(' +  args_str + ')')
+                s.append('  ' + call)
 
         s.append('}')
 
@@ -676,6 +1194,7 @@ class Parametor(Base):
     def to_arg_c(self):
         name = self.typename.raw
         if not self.typename: return 'FIXME' # FIXME
+        if self.typename.is_block: return self.typename.to_block_literal_c(self.name.to_c())
         if self.typename and self.typename.objc_class:
             if self.typename.raw == 'NSError':
                 return '(' + self.typename.raw + '**)&' + self.name.to_c()
@@ -691,13 +1210,7 @@ class Parametor(Base):
     def to_arg_go(self):
         name = self.name.to_go()
         if not self.typename: return 'FIXMEz' # FIXME
-        if self.typename and self.typename.objc_class: return name + '.Self()' 
-        if self.typename.raw == 'id': return 'unsafe.Pointer(' + name + ')'
-        if self.typename.raw == 'char*': return 'C.CString(' + name + ')'
-        if self.typename.raw == 'NSRect': return 'C.CGRectMake(C.CGFloat(%s.X), C.CGFloat(%s.Y), C.CGFloat(%s.Width), C.CGFloat(%s.Height))' % (name, name, name, name)
-        if self.typename.raw == 'NSPoint': return 'C.CGPointMake(C.CGFloat(%s.X), C.CGFloat(%s.Y))' % (name, name)
-        if self.typename: return name
-        return 'FIXME' # FIXME
+        return self.typename.unbox_value_go(name)
 
     def to_param_go(self):
         name = self.name.to_go()
@@ -710,6 +1223,7 @@ class Parametor(Base):
 
 class Enum(Base):
     declared_enumtypes = set()
+    declared_constants = set()
     deprecated = set([
         'NSDataWritingFileProtectionNone',
         'NSDataWritingFileProtectionComplete',
@@ -720,15 +1234,54 @@ class Enum(Base):
         'NSURLErrorCancelledReasonBackgroundUpdatesDisabled',
     ])
 
+    unsigned_kinds = set([
+        TypeKind.CHAR_U,
+        TypeKind.UCHAR,
+        TypeKind.USHORT,
+        TypeKind.UINT,
+        TypeKind.ULONG,
+        TypeKind.ULONGLONG,
+        TypeKind.UINT128,
+    ])
+
     def __init__(self, node):
         self.name = node.displayname # FIXME: Typename?
-        self.constants = filter(lambda x:not x in Enum.deprecated, map(lambda x:x.displayname, filter_kind(CursorKind.ENUM_CONSTANT_DECL, node)))
+
+        # enum_value of the bindings reads a value as signed when the underlying type is a typedef (e.g. NS_OPTIONS(NSUInteger, ...)),
+        # which makes NSUIntegerMax -1, so the canonical type decides it.
+        if node.enum_type.get_canonical().kind in Enum.unsigned_kinds:
+            value_of = conf.lib.clang_getEnumConstantDeclUnsignedValue
+        else:
+            value_of = conf.lib.clang_getEnumConstantDeclValue
+
+        # values are evaluated by libclang, so cgo does not need to resolve each constant when building.
+        # An enum may be declared more than once, so constants are emitted at the first declaration only.
+        # They are typed with the C type of this package, so constants are emitted in every package which uses them.
+        cs = filter(lambda x:not x.displayname in Enum.deprecated, filter_kind(CursorKind.ENUM_CONSTANT_DECL, node))
+        self.constants = map(lambda x:(x.displayname, value_of(x)), filter(lambda x:not x.displayname in Enum.declared_constants, cs))
+        Enum.declared_constants.update(map(lambda x:x[0], self.constants))
 
         if len(self.name) > 0:
             Enum.declared_enumtypes.add(self.name)
 
+    def to_go(self):
+        if len(self.name) == 0: return None # anonymous enums are untyped
+        if self.name in Typedef.declared_names: return 'C.' + self.name
+        return 'C.enum_' + self.name
+
+    def compile_go(self):
+        if not self.constants: return ''
+
+        t = self.to_go()
+        s = ['// ' + (self.name if t else '(anonymous)'), 'const (']
+        for (name, value) in self.constants:
+            s.append('  ' + name + (' ' + t if t else '') + ' = ' + str(value))
+        s.append(')')
+        return '\n'.join(s)
+
 class Typedef(Base):
     declared_typedefs = {}
+    declared_names = set()
     deprecated = set([
     ])
 
@@ -739,6 +1292,7 @@ class Typedef(Base):
     @staticmethod
     def add(node):
         td = Typedef(node)
+        Typedef.declared_names.add(td.typename)
         if isinstance(td.desttype, InvalidType):
             Typedef.declared_typedefs[td.typename] = td
         return td
@@ -749,43 +1303,248 @@ class Typedef(Base):
         return Typedef.declared_typedefs[ident]
 
 
-def parse_root(node):
+# With drain, objects autoreleased by call are released every 1024 iterations.
+# An autorelease pool must be drained on the thread which created it, so the benchmark is locked to its thread.
+def compile_benchmark_go(name, setup, call, drain=False):
+    s = ['func Benchmark' + name + '(b *testing.B) {']
+    if drain:
+        s.append('  runtime.LockOSThread()')
+        s.append('  defer runtime.UnlockOSThread()')
+        s.append('  pool := ccgBenchPoolPush()')
+        s.append('  defer func() { ccgBenchPoolPop(pool) }()')
+    if setup:
+        s.extend(map(lambda x:'  ' + x, setup))
+        s.append('  b.ResetTimer()')
+    s.append('  for i := 0; i < b.N; i++ {')
+    s.append('    ' + call)
+    if drain:
+        s.append('    if i%1024 == 1023 {')
+        s.append('      ccgBenchPoolPop(pool)')
+        s.append('      pool = ccgBenchPoolPush()')
+        s.append('    }')
+    s.append('  }')
+    s.append('}')
+    return '\n'.join(s)
+
+def create_bench_source(interfaces):
+    # cgo can not be used in _test.go files, so geometry conversions are measured through ccgBench* helpers in the package.
+    s = []
+    if Registry.is_base():
+        s.append(compile_benchmark_go('Id_', ['var v int', 'p := unsafe.Pointer(&v)'], 'Id_(p)'))
+        s.append(compile_benchmark_go('NSRect_', ['r := NSRect{1, 2, 3, 4}'], 'ccgBenchNSRect_(r)'))
+        s.append(compile_benchmark_go('NSPoint_', ['p := NSPoint{1, 2}'], 'ccgBenchNSPoint_(p)'))
+    s.extend(filter(lambda x:x, map(lambda x:x.compile_bench_go(), interfaces)))
+    body = '\n'.join(s) + '\n'
+
+    imports = []
+    if 'runtime.' in body: imports.append('  "runtime"')
+    imports.append('  "testing"')
+    if 'unsafe.' in body: imports.append('  "unsafe"')
+    return 'package ' + Registry.package + '\n\nimport (\n' + '\n'.join(imports) + '\n)\n\n' + body
+
+
+def sorted_signatures():
+    return map(lambda x:BlockType.used_signatures[x], sorted(BlockType.used_signatures.keys()))
+
+def create_export_source(main_thread=False):
+    # Exported Go functions can not be in a file whose preamble has C definitions, so they are in a separate file.
+    s = []
+    if Registry.is_base():
+        s.append('''//export CCG_releaseHandle
+func CCG_releaseHandle(h C.uintptr_t) {
+  DeleteHandle(uintptr(h))
+}''')
+    if main_thread and Registry.is_base():
+        s.append('''//export CCG_runMainBatch
+func CCG_runMainBatch(h C.uintptr_t) {
+  fns := LookupHandle(uintptr(h)).([]func())
+  DeleteHandle(uintptr(h))
+  for _, f := range fns {
+    f()
+  }
+}''')
+    s.extend(map(lambda x:x.compile_export_go(), sorted_signatures()))
+    body = '\n'.join(s) + '\n'
+
+    # trampolines box arguments with wrappers of the packages providing their classes
+    classes = set()
+    for b in sorted_signatures():
+        classes.update(map(lambda x:x.raw, filter(lambda x:isinstance(x, ObjcClassType), [b.result] + b.args)))
+    packages = filter(lambda x:x + '.' in body, Registry.used_packages(classes))
+
+    # cgo only forbids definitions here, so the headers of the generated source are imported for the C types of trampolines (e.g. C.NSRange).
+    return 'package ' + Registry.package + '''
+/*
+#include <stdbool.h>
+#include <stdint.h>
+#import <Cocoa/Cocoa.h>
+*/
+import "C"
+''' + ('import "unsafe"\n' if 'unsafe.' in body else '') + compile_imports_go(packages) + '\n' + body
+
+
+def compile_imports_go(packages):
+    return ''.join(map(lambda x:'import ' + x + ' "' + Registry.imports[x] + '"\n', packages))
+
+# NSRect_ and so on convert C types, which are local to each package, so they are emitted in every package.
+def compile_geometry_go():
+    s = ['', '///// conversions from C']
+    for t in ['NSRect', 'NSPoint', 'NSSize', 'NSRange']:
+        go = Registry.runtime_name(t)
+        s.append('func ' + t + '_(r C.' + t + ') ' + go + ' {')
+        s.append('    return *(*' + go + ')(unsafe.Pointer(&r))')
+        s.append('}')
+    return '\n'.join(s)
+
+
+# Interfaces being emitted by emit_interfaces().
+# Worker processes are forked after this is set, so they inherit the parsed model
+# and only indices and the emitted strings cross the process boundary.
+emit_targets = []
+
+def emit_interface(index):
+    i = emit_targets[index]
+    return (i.compile_c(), i.compile_go())
+
+def emit_interfaces(interfaces, jobs=1):
+    global emit_targets
+    emit_targets = interfaces
+
+    indices = range(len(interfaces))
+    if jobs <= 1 or len(indices) < 2:
+        return map(emit_interface, indices)
+
+    from multiprocessing import Pool
+    pool = Pool(jobs)
+    try:
+        # Pool.map() returns results in the order of indices, so the output is the same as a serial run.
+        return pool.map(emit_interface, indices, max(1, len(indices) / (jobs * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Writes the Go source to out, and returns other outputs as a list of (filename, content).
+def parse_root(node, opts, out):
+    outputs = []
     if node.kind == CursorKind.TRANSLATION_UNIT:
+        reset_registries()
+        Registry.load(opts)
+        error = Registry.check_features()
+        if error: raise ValueError(error)
+        BlockType.enabled = bool(opts.export_output)
+        Method.route_main_thread = opts.main_thread
         (interfaces, enums) = parse_translation_unit(node)
+        # classes generated in packages imported from the registry are not generated again
+        interfaces = filter(lambda x:not x.typename.raw in Registry.provided_classes, interfaces)
+        Interface.emit_snapshots = opts.snapshots
+        emitted = emit_interfaces(interfaces, opts.jobs)
 
-        print '''package sample
+        print >>out, 'package ' + opts.package + '''
 /*
 #cgo CFLAGS: -x objective-c -I../../objc -I../../out
 #cgo LDFLAGS: -framework Foundation -framework AppKit
 #import <Cocoa/Cocoa.h>
 #import <objc/message.h>
 #import <objc/runtime.h>
-
-// runtime
-const char* CCG_object_getClassName(void* px) {
-    return object_getClassName(px);
+'''
+        if Registry.is_base():
+            print >>out, '''// runtime
+void* CCG_object_getClass(void* px) {
+    return (void*)object_getClass((id)px);
+}
+// writes the names of cls and its superclasses to names, and returns the number of them
+int CCG_class_getHierarchy(void* cls, const char** names, int max) {
+    int n = 0;
+    Class c;
+    for (c = (Class)cls; c && n < max; c = class_getSuperclass(c)) names[n++] = class_getName(c);
+    return n;
 }
 // NSObject
 const char* NSObject_descripton(void* p) {
     return [[(id)p description] UTF8String];
 }
 '''
-        print ''.join(map(lambda x:x.compile_c()+'\n', interfaces))
-        print '\n\n'
+        if opts.export_output:
+            print >>out, '// callbacks into Go (defined in %s)' % os.path.basename(opts.export_output)
+            if Registry.is_base():
+                print >>out, 'extern void CCG_releaseHandle(uintptr_t h);'
+            print >>out, '\n'.join(map(lambda x:x.compile_extern_c(), sorted_signatures()))
+            print >>out, '''
+// releases a Go handle when the last block which captures this box is released
+@interface CCGHandleBox : NSObject {
+    uintptr_t handle;
+}
+- (id)initWithHandle:(uintptr_t)h;
+@end'''
+            # the class is implemented once, in the package providing the runtime
+            if Registry.is_base():
+                print >>out, '''@implementation CCGHandleBox
+- (id)initWithHandle:(uintptr_t)h {
+    if ((self = [super init])) handle = h;
+    return self;
+}
+- (void)dealloc {
+    CCG_releaseHandle(handle);
+    [super dealloc];
+}
+@end
+'''
+        if opts.main_thread:
+            print >>out, '''// runs fn on the main thread and waits for it
+static void CCG_onMain(void (^fn)(void)) {
+    if ([NSThread isMainThread]) fn();
+    else dispatch_sync(dispatch_get_main_queue(), fn);
+}'''
+        if opts.main_thread and Registry.is_base():
+            print >>out, '''// runs a batch of Go funcs on the main thread
+extern void CCG_runMainBatch(uintptr_t h);
+static void CCG_runMainBatch_f(void* h) {
+    CCG_runMainBatch((uintptr_t)h);
+}
+void CCG_dispatchMain(uintptr_t h, bool wait) {
+    if (!wait) dispatch_async_f(dispatch_get_main_queue(), (void*)h, CCG_runMainBatch_f);
+    else if ([NSThread isMainThread]) CCG_runMainBatch(h);
+    else dispatch_sync_f(dispatch_get_main_queue(), (void*)h, CCG_runMainBatch_f);
+}
+'''
+        if opts.bench_output:
+            # static, since every package generated with --bench-output has them
+            print >>out, '''// autorelease pools for benchmarks, which run without an event loop
+static void* CCG_benchPoolPush(void) {
+    return [[NSAutoreleasePool alloc] init];
+}
+static void CCG_benchPoolPop(void* p) {
+    [(NSAutoreleasePool*)p drain];
+}
+'''
+        print >>out, ''.join(map(lambda x:x[0]+'\n', emitted))
+        print >>out, '\n\n'
 
-        print '''*/
+        print >>out, '''*/
 import "C"
-import "unsafe"
-'''
+import "unsafe"'''
+        if Registry.is_base():
+            print >>out, '''import "sync"
+import "sync/atomic"'''
+            if opts.main_thread:
+                print >>out, 'import "runtime"'
+        print >>out, compile_imports_go(Registry.used_packages(ObjcClassType.used_classes))
+
         # output enum constants
-        # print 'const ('
-        # for e in enums:
-        #     for i in e.constants:
-        #         print '  ' +  i + ' = C.' + i
-        # print ')'
+        print >>out, '\n'.join(filter(lambda x:x, map(lambda x:x.compile_go(), enums)))
 
-        # 
-        print ''' 
+        # keep imports used even if nothing generated refers to them
+        for p in Registry.used_packages(ObjcClassType.used_classes):
+            if p == Registry.runtime_package:
+                print >>out, 'var _ %s.Id' % p
+            else:
+                print >>out, 'var _ *%s.%s' % (p, sorted(filter(lambda x:Registry.provided_classes[x] == p, Registry.provided_classes.keys()))[0])
+
+        print >>out, compile_geometry_go()
+
+        if Registry.is_base():
+            print >>out, ''' 
 type Id unsafe.Pointer
 
 func Id_(r unsafe.Pointer) Id {
@@ -793,6 +1552,10 @@ func Id_(r unsafe.Pointer) Id {
 }
 
 ///// struct for Go
+// These have the same memory layout as the C types on the 64-bit target,
+// so values are reinterpreted instead of being converted field by field.
+type CGFloat float64
+
 type NSRect struct {
     X float64
     Y float64
@@ -800,19 +1563,33 @@ type NSRect struct {
     Height float64
 }
 
-func NSRect_(r C.NSRect) NSRect {
-    return NSRect{float64(r.origin.x), float64(r.origin.y), float64(r.size.width), float64(r.size.height)}
-}
-
 type NSPoint struct {
     X float64
     Y float64
 }
 
-func NSPoint_(r C.NSPoint) NSPoint {
-    return NSPoint{float64(r.x), float64(r.y)}
+type NSSize struct {
+    Width float64
+    Height float64
+}
+
+type NSRange struct {
+    Location uint64
+    Length uint64
 }
 
+// compile-time layout checks: a size mismatch makes one of the array lengths overflow
+var _ [unsafe.Sizeof(CGFloat(0)) - unsafe.Sizeof(C.CGFloat(0))]byte
+var _ [unsafe.Sizeof(C.CGFloat(0)) - unsafe.Sizeof(CGFloat(0))]byte
+var _ [unsafe.Sizeof(NSRect{}) - unsafe.Sizeof(C.NSRect{})]byte
+var _ [unsafe.Sizeof(C.NSRect{}) - unsafe.Sizeof(NSRect{})]byte
+var _ [unsafe.Sizeof(NSPoint{}) - unsafe.Sizeof(C.NSPoint{})]byte
+var _ [unsafe.Sizeof(C.NSPoint{}) - unsafe.Sizeof(NSPoint{})]byte
+var _ [unsafe.Sizeof(NSSize{}) - unsafe.Sizeof(C.NSSize{})]byte
+var _ [unsafe.Sizeof(C.NSSize{}) - unsafe.Sizeof(NSSize{})]byte
+var _ [unsafe.Sizeof(NSRange{}) - unsafe.Sizeof(C.NSRange{})]byte
+var _ [unsafe.Sizeof(C.NSRange{}) - unsafe.Sizeof(NSRange{})]byte
+
 
 ///// additional for Go
 func (obj NSObject) Self() unsafe.Pointer {
@@ -822,24 +1599,233 @@ func (obj NSObject) String() string {
     return C.GoString(C.NSObject_descripton(obj.Self()))
 }
 func (obj NSObject) GetClassName() string {
-    p := C.CCG_object_getClassName(obj.Self())
-    return C.GoString(p)
+    return ccgClassInfoOf(C.CCG_object_getClass(obj.Self())).name
+}
+func (obj NSObject) Downcast() ObjCObject {
+    return Downcast(obj.self)
+}
+
+///// class cache
+// ObjCObject is implemented by all wrappers.
+type ObjCObject interface {
+    Self() unsafe.Pointer
+}
+
+type ccgClassInfo struct {
+    name string
+    ctor func(Id) ObjCObject // wrapper of the most-derived registered class
+}
+
+var ccgClasses struct {
+    sync.Mutex
+    ctors map[string]func(Id) ObjCObject
+    infos atomic.Value // map[unsafe.Pointer]*ccgClassInfo, replaced on update
+}
+
+// RegisterClass makes Downcast use ctor for instances of the class and its subclasses.
+func RegisterClass(name string, ctor func(Id) ObjCObject) {
+    ccgClasses.Lock()
+    defer ccgClasses.Unlock()
+
+    if ccgClasses.ctors == nil {
+        ccgClasses.ctors = map[string]func(Id) ObjCObject{}
+    }
+    ccgClasses.ctors[name] = ctor
+    ccgClasses.infos.Store(map[unsafe.Pointer]*ccgClassInfo{})
+}
+
+// Class pointers live as long as the process, so the cache is keyed by them and never invalidated
+// except by RegisterClass. A cache hit costs no cgo call.
+func ccgClassInfoOf(cls unsafe.Pointer) *ccgClassInfo {
+    infos, _ := ccgClasses.infos.Load().(map[unsafe.Pointer]*ccgClassInfo)
+    if info, ok := infos[cls]; ok {
+        return info
+    }
+
+    var names [64]*C.char
+    n := int(C.CCG_class_getHierarchy(cls, &names[0], C.int(len(names))))
+    info := &ccgClassInfo{name: C.GoString(names[0])}
+
+    ccgClasses.Lock()
+    defer ccgClasses.Unlock()
+
+    for i := 0; i < n && info.ctor == nil; i++ {
+        info.ctor = ccgClasses.ctors[C.GoString(names[i])]
+    }
+    infos, _ = ccgClasses.infos.Load().(map[unsafe.Pointer]*ccgClassInfo)
+    m := make(map[unsafe.Pointer]*ccgClassInfo, len(infos)+1)
+    for k, v := range infos {
+        m[k] = v
+    }
+    m[cls] = info
+    ccgClasses.infos.Store(m)
+    return info
+}
+
+// Downcast returns the wrapper of the most-derived generated class of i (e.g. NSWindow for a window returned as Id)
+// with one cgo call.
+func Downcast(i Id) ObjCObject {
+    if i == nil {
+        return nil
+    }
+    info := ccgClassInfoOf(C.CCG_object_getClass(unsafe.Pointer(i)))
+    if info.ctor == nil {
+        return NSObject_(i)
+    }
+    return info.ctor(i)
 }
 ///// END
 '''
+        if opts.export_output and Registry.is_base():
+            print >>out, '''///// handle table for Go values passed to Objective-C (e.g. funcs of blocks)
+// Lookups are lock-free: slots live in fixed-size chunks which never move, and the list of chunks
+// is replaced atomically when it grows. Released slots are reused, so allocation is amortized.
+// Each slot is an atomic.Value, so a lookup on another thread (e.g. a callback on the main queue)
+// is ordered after the store by NewHandle.
+const ccgHandleChunkSize = 256
+
+// atomic.Value requires all stores to have the same type, so values are wrapped
+type ccgHandleSlot struct {
+    v interface{}
+}
+
+type ccgHandleChunk [ccgHandleChunkSize]atomic.Value
+
+var ccgHandles struct {
+    sync.Mutex
+    chunks atomic.Value // []*ccgHandleChunk
+    free []uintptr
+    next uintptr
+}
+
+// NewHandle stores v and returns a handle which can be passed to C.
+func NewHandle(v interface{}) uintptr {
+    ccgHandles.Lock()
+    defer ccgHandles.Unlock()
+
+    var h uintptr
+    if n := len(ccgHandles.free); n > 0 {
+        h = ccgHandles.free[n-1]
+        ccgHandles.free = ccgHandles.free[:n-1]
+    } else {
+        ccgHandles.next++ // 0 is never used as a handle
+        h = ccgHandles.next
+        chunks, _ := ccgHandles.chunks.Load().([]*ccgHandleChunk)
+        if int(h/ccgHandleChunkSize) >= len(chunks) {
+            chunks = append(chunks[:len(chunks):len(chunks)], new(ccgHandleChunk))
+            ccgHandles.chunks.Store(chunks)
+        }
+    }
+    ccgHandles.chunks.Load().([]*ccgHandleChunk)[h/ccgHandleChunkSize][h%ccgHandleChunkSize].Store(ccgHandleSlot{v})
+    return h
+}
+
+// LookupHandle returns the value of a handle created by NewHandle.
+func LookupHandle(h uintptr) interface{} {
+    chunks := ccgHandles.chunks.Load().([]*ccgHandleChunk)
+    slot, _ := chunks[h/ccgHandleChunkSize][h%ccgHandleChunkSize].Load().(ccgHandleSlot)
+    return slot.v
+}
+
+// DeleteHandle releases a handle. Blocks release their handles by themselves.
+func DeleteHandle(h uintptr) {
+    ccgHandles.Lock()
+    defer ccgHandles.Unlock()
+
+    ccgHandles.chunks.Load().([]*ccgHandleChunk)[h/ccgHandleChunkSize][h%ccgHandleChunkSize].Store(ccgHandleSlot{})
+    ccgHandles.free = append(ccgHandles.free, h)
+}
+///// END
+'''
+        if opts.main_thread and Registry.is_base():
+            print >>out, '''///// main thread
+// Locks the main goroutine to the main thread, which runs package initialization,
+// so that main() can run the event loop (e.g. NSApplication.Run) on the main thread.
+func init() {
+    runtime.LockOSThread()
+}
+
+// OnMain runs fns on the main thread in one hop, and waits for them.
+// Wrappers of main-thread-only classes called in fns do not hop again.
+// The main thread must be running the event loop unless OnMain is called on it.
+func OnMain(fns ...func()) {
+    if len(fns) > 0 {
+        C.CCG_dispatchMain(C.uintptr_t(NewHandle(fns)), true)
+    }
+}
+
+// OnMainAsync queues fns to run on the main thread in one hop, and returns immediately.
+func OnMainAsync(fns ...func()) {
+    if len(fns) > 0 {
+        C.CCG_dispatchMain(C.uintptr_t(NewHandle(fns)), false)
+    }
+}
+///// END
+'''
+        if opts.bench_output:
+            print >>out, '''///// benchmark support (called from %s)
+func ccgBenchPoolPush() unsafe.Pointer {
+    return C.CCG_benchPoolPush()
+}
+func ccgBenchPoolPop(p unsafe.Pointer) {
+    C.CCG_benchPoolPop(p)
+}''' % os.path.basename(opts.bench_output)
+        if opts.bench_output and Registry.is_base():
+            print >>out, '''func ccgBenchNSRect_(r NSRect) NSRect {
+    return NSRect_(%s)
+}
+func ccgBenchNSPoint_(p NSPoint) NSPoint {
+    return NSPoint_(%s)
+}
+''' % (CType('NSRect', False).unbox_value_go('r'), CType('NSPoint', False).unbox_value_go('p'))
+
         # 
-        print ''.join(map(lambda x:x.compile_go()+'\n', interfaces))
-        print '\n'
+        print >>out, ''.join(map(lambda x:x[1]+'\n', emitted))
+        print >>out, '\n'
            
         # create skelton implementations of interfaces that have no interface declaration.
-        for i in ObjcClassType.used_classes.difference(Interface.declared_classes):
-            print '''type %s struct {
-    NSObject
+        skeletons = ObjcClassType.used_classes.difference(Interface.declared_classes).difference(Registry.provided_classes.keys())
+        nsobject = Registry.class_name('NSObject')
+        id = Registry.runtime_name('Id')
+        for i in skeletons:
+            print >>out, '''type %s struct {
+    %s
 }
-func %s_(i Id) %s {
-    return %s{ NSObject_(i) }
+func %s_(i %s) %s {
+    return %s{ %s_(i) }
 }
-''' % (i,i,i,i)
+''' % (i,nsobject,i,id,i,i,nsobject)
+
+        # register wrappers for Downcast()
+        generated = map(lambda x:x.typename.raw, filter(lambda x:x.typename.is_cgo_acceptable, interfaces))
+        classes = generated + sorted(skeletons)
+        print >>out, 'func init() {'
+        for i in classes:
+            print >>out, '  %s("%s", func(i %s) %s { return %s_(i) })' % (Registry.runtime_name('RegisterClass'), i, id, Registry.runtime_name('ObjCObject'), i)
+        print >>out, '}'
+
+        if opts.export_output:
+            outputs.append((opts.export_output, create_export_source(opts.main_thread)))
+
+        if opts.bench_output:
+            outputs.append((opts.bench_output, create_bench_source(interfaces)))
+
+        # skeletons are not registered, so a package generated later generates its own skeletons
+        if opts.registry:
+            outputs.append((opts.registry, Registry.dump(generated)))
+
+    return outputs
+
+
+# Registries are filled while building the model, so they are cleared before a translation unit is parsed again.
+def reset_registries():
+    ObjcClassType.used_classes = set()
+    Interface.declared_classes = set()
+    Enum.declared_enumtypes = set()
+    Enum.declared_constants = set()
+    Typedef.declared_typedefs = {}
+    Typedef.declared_names = set()
+    BlockType.used_signatures = {}
 
 
 def parse_translation_unit(node):
@@ -859,12 +1845,108 @@ def parse_translation_unit(node):
     return (interfaces, enums)
 
 
-def create_go_source(node):
-    parse_root(node)
+# Returns all outputs as a list of (filename, content). The filename of the Go source is None when it goes to stdout.
+def create_go_source(node, opts):
+    out = StringIO()
+    outputs = parse_root(node, opts, out)
+    return [(opts.output, out.getvalue())] + outputs
+
+def write_outputs(outputs):
+    for (filename, content) in outputs:
+        if not filename:
+            sys.stdout.write(content)
+            continue
+
+        # leave unchanged files untouched so that go build does not rebuild them
+        if os.path.exists(filename):
+            f = open(filename)
+            current = f.read()
+            f.close()
+            if current == content: continue
+
+        f = open(filename, 'w')
+        f.write(content)
+        f.close()
+
+
+def get_dependencies(tu):
+    return [tu.spelling] + map(lambda x:x.include.name, tu.get_includes())
+
+def get_mtimes(filenames):
+    def mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+    return dict(map(lambda x:(x, mtime(x)), filenames))
+
+# Keeps the translation unit and the generated outputs in memory, and regenerates when the input headers change.
+# Clients connected to opts.socket send a line and get 'ok' or 'error: ...' after the outputs are up to date.
+def watch(tu, opts):
+    import select, signal, socket, traceback
+
+    # exit through the finally clause below, which removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = None
+    if opts.socket:
+        if os.path.exists(opts.socket): os.unlink(opts.socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(opts.socket)
+        server.listen(5)
+
+    state = {'mtimes': get_mtimes(get_dependencies(tu)), 'outputs': None}
+
+    def regenerate():
+        mtimes = get_mtimes(state['mtimes'].keys())
+        if mtimes != state['mtimes']:
+            sys.stderr.write('reparsing %s\n' % tu.spelling)
+            tu.reparse()
+            state['mtimes'] = get_mtimes(get_dependencies(tu))
+            state['outputs'] = None
+        if state['outputs'] is None:
+            state['outputs'] = create_go_source(tu.cursor, opts)
+        write_outputs(state['outputs'])
+
+    try:
+        regenerate()
+        while True:
+            ready = select.select([server] if server else [], [], [], opts.interval)[0]
+            if not ready:
+                if get_mtimes(state['mtimes'].keys()) != state['mtimes']:
+                    try:
+                        regenerate()
+                    except Exception:
+                        traceback.print_exc()
+                continue
+
+            conn = server.accept()[0]
+            try:
+                # a client which never sends must not stop regeneration and other clients
+                conn.settimeout(opts.interval)
+                try:
+                    conn.recv(1024)
+                except socket.timeout:
+                    sys.stderr.write('no request from a client on %s\n' % opts.socket)
+                    continue
+                try:
+                    regenerate()
+                    conn.sendall('ok\n')
+                except Exception, e:
+                    traceback.print_exc()
+                    conn.sendall('error: %s\n' % e)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.close()
+            os.unlink(opts.socket)
 
 
 def main():
-    from clang.cindex import Index
+    from clang.cindex import Index, TranslationUnit
     from pprint import pprint
 
     from optparse import OptionParser, OptionGroup
@@ -872,21 +1954,65 @@ def main():
     # TODO: global opts
 
     parser = OptionParser("usage: %prog [options] {filename} [clang-args*]")
+    parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                      help='write the Go source to FILE instead of stdout; FILE is not rewritten if nothing changed')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true', default=False,
+                      help='keep running and regenerate when the input headers change (requires --output)')
+    parser.add_option('--socket', dest='socket', metavar='PATH',
+                      help='in watch mode, regenerate on request from clients of a unix socket at PATH')
+    parser.add_option('--interval', dest='interval', type='float', default=0.5, metavar='SECONDS',
+                      help='in watch mode, check the input headers every SECONDS [default: %default]')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, metavar='N',
+                      help='emit interfaces with N worker processes [default: %default]')
+    parser.add_option('--snapshots', dest='snapshots', action='store_true', default=False,
+                      help='emit Snapshot()/SetSnapshot() which read and write all properties of an object in one cgo call')
+    parser.add_option('--export-output', dest='export_output', metavar='FILE',
+                      help='write Go functions called back from Objective-C to FILE, and accept block parameters')
+    parser.add_option('--main-thread', dest='main_thread', action='store_true', default=False,
+                      help='run wrappers of main-thread-only classes (AppKit) on the main thread, and emit OnMain()/OnMainAsync() (requires --export-output)')
+    parser.add_option('--package', dest='package', default='sample', metavar='NAME',
+                      help='name of the generated Go package [default: %default]')
+    parser.add_option('--registry', dest='registry', metavar='FILE',
+                      help='import classes generated in packages recorded in FILE instead of generating them again, and record this package in FILE (requires --import-path)')
+    parser.add_option('--import-path', dest='import_path', metavar='PATH',
+                      help='Go import path of the generated package, recorded in the registry')
+    parser.add_option('--bench-output', dest='bench_output', metavar='FILE',
+                      help='write Go benchmarks of the generated wrappers to FILE (e.g. cocoa_sample_test.go)')
     parser.disable_interspersed_args()
     (opts, args) = parser.parse_args()
 
+    if opts.jobs < 1:
+        parser.error('--jobs must be a positive number')
+    if opts.main_thread and not opts.export_output:
+        parser.error('--main-thread requires --export-output')
+    if opts.watch and not opts.output:
+        parser.error('--watch requires --output')
+    if opts.socket and not opts.watch:
+        parser.error('--socket requires --watch')
+    if opts.registry and not opts.import_path:
+        parser.error('--registry requires --import-path')
+    if opts.registry:
+        # checked here as well as in parse_root() to report it as a usage error
+        Registry.load(opts)
+        if Registry.check_features(): parser.error(Registry.check_features())
+
     if len(args) > 0:
         args.append('-c')
         args.append('-ObjC')
         args.append('-m64')
         args.append('-fobjc-arc')
 
-        tu = Index.create().parse(None, args)
-        if tu:
-            create_go_source(tu.cursor)
-        else:
+        # A precompiled preamble makes reparsing in watch mode cheap.
+        options = TranslationUnit.PARSE_PRECOMPILED_PREAMBLE if opts.watch else 0
+        tu = Index.create().parse(None, args, options=options)
+        if not tu:
             parser.error("unable to load input")
 
+        if opts.watch:
+            watch(tu, opts)
+        else:
+            write_outputs(create_go_source(tu.cursor, opts))
+
     else:
         parser.error('invalid number arguments')
 
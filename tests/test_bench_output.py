@@ -0,0 +1,63 @@
+"""
+Runs clang-objcgo.py --bench-output on examples/BenchSample.h.
+Run with the Python 2 interpreter which has the libclang bindings: python -m unittest discover tests
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'clang-objcgo.py')
+HEADER = os.path.join(ROOT, 'examples', 'BenchSample.h')
+
+try:
+    import clang.cindex
+    has_clang = True
+except ImportError:
+    has_clang = False
+
+
+# the script is written for Python 2
+@unittest.skipUnless(has_clang and sys.version_info[0] == 2, 'needs Python 2 with the libclang bindings')
+class BenchOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bench = os.path.join(self.dir, 'bench_sample_test.go')
+        self.source = subprocess.check_output([sys.executable, SCRIPT, '--bench-output', self.bench, HEADER])
+        with open(self.bench) as f:
+            self.content = f.read()
+        self.benchmarks = re.findall(r'^func (Benchmark\w+)\(b \*testing\.B\)', self.content, re.M)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_imports(self):
+        self.assertTrue(self.content.startswith('package sample\n'))
+        imports = re.search(r'^import \(\n(.*?)\n\)', self.content, re.M | re.S).group(1)
+        self.assertEqual(imports.split('\n'), ['  "runtime"', '  "testing"', '  "unsafe"'])
+
+    def test_benchmark_names(self):
+        self.assertEqual(self.benchmarks, [
+            'BenchmarkId_',
+            'BenchmarkNSRect_',
+            'BenchmarkNSPoint_',
+            'BenchmarkNSObject_Hash',
+            'BenchmarkNSString_Length',
+            'BenchmarkNSView_Frame',
+            'BenchmarkNSView_IsOpaque',
+        ])
+
+    def test_getters_drain_autorelease_pool(self):
+        body = self.content[self.content.index('func BenchmarkNSView_IsOpaque'):]
+        self.assertTrue('obj := NSView_init()\n  b.ResetTimer()' in body)
+        self.assertTrue('ccgBenchPoolPop(pool)' in body)
+        self.assertTrue('func ccgBenchPoolPush() unsafe.Pointer {' in self.source)
+        self.assertTrue('static void CCG_benchPoolPop(void* p) {' in self.source)
+
+
+if __name__ == '__main__':
+    unittest.main()
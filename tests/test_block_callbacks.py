@@ -0,0 +1,88 @@
+"""
+Runs clang-objcgo.py --export-output on examples/BlockSample.h.
+Run with the Python 2 interpreter which has the libclang bindings: python -m unittest discover tests
+The generated package is also built with a caller in another package where Go and the SDK are available (macOS).
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'clang-objcgo.py')
+HEADER = os.path.join(ROOT, 'examples', 'BlockSample.h')
+
+# funcs of blocks are written by packages other than the generated one, so they must not have cgo types
+CALLER = '''package main
+
+import "sample"
+
+func main() {
+    a := sample.NSArray_init()
+    a.EnumerateObjectsUsingBlock(func(obj sample.Id, idx uint64, stop *bool) {
+        *stop = true
+    })
+    a.IndexOfObjectPassingTest(func(obj sample.Id, idx uint64, stop *bool) bool {
+        return idx == 0
+    })
+    sample.NSIndexSet_init().EnumerateRangesUsingBlock(func(r sample.NSRange, stop *bool) {
+        *stop = r.Length == 0
+    })
+}
+'''
+
+try:
+    import clang.cindex
+    has_clang = True
+except ImportError:
+    has_clang = False
+
+def find_go():
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(d, 'go')): return os.path.join(d, 'go')
+    return None
+
+
+# the script is written for Python 2
+@unittest.skipUnless(has_clang and sys.version_info[0] == 2, 'needs Python 2 with the libclang bindings')
+class BlockCallbacksTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.package = os.path.join(self.dir, 'src', 'sample')
+        os.makedirs(self.package)
+        self.export = os.path.join(self.package, 'block_sample_export.go')
+        self.source = subprocess.check_output([sys.executable, SCRIPT, '--export-output', self.export, HEADER])
+        with open(os.path.join(self.package, 'block_sample.go'), 'w') as f:
+            f.write(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_callback_types(self):
+        params = re.findall(r'^func \(goobj \w+\) \w+\(\w+ (func\(.*\).*?)\) ', self.source, re.M)
+        self.assertEqual(params, [
+            'func(Id, uint64, *bool) bool',
+            'func(Id, uint64, *bool)',
+            'func(NSRange, *bool)',
+        ])
+
+    def test_trampolines_convert_values(self):
+        with open(self.export) as f:
+            export = f.read()
+        self.assertTrue('  r := f(Id_(a0), uint64(a1), (*bool)(unsafe.Pointer(a2)))\n  return C.bool(r)\n' in export)
+
+    @unittest.skipUnless(sys.platform == 'darwin' and find_go(), 'needs Go and the macOS SDK')
+    def test_call_from_another_package(self):
+        main = os.path.join(self.dir, 'src', 'main')
+        os.makedirs(main)
+        with open(os.path.join(main, 'main.go'), 'w') as f:
+            f.write(CALLER)
+        env = dict(os.environ, GOPATH=self.dir, GO111MODULE='off')
+        subprocess.check_call([find_go(), 'build', '-o', os.path.join(self.dir, 'main.out'), 'main'], cwd=self.dir, env=env)
+
+
+if __name__ == '__main__':
+    unittest.main()
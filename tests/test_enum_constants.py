@@ -0,0 +1,62 @@
+"""
+Runs clang-objcgo.py on enums with unsigned and signed underlying typedefs.
+Run with the Python 2 interpreter which has the libclang bindings: python -m unittest discover tests
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'clang-objcgo.py')
+
+HEADER = '''
+typedef unsigned long NSUInteger;
+typedef long NSInteger;
+#define NSUIntegerMax (~0UL)
+
+typedef enum NSDragOperation : NSUInteger {
+    NSDragOperationNone = 0,
+    NSDragOperationEvery = NSUIntegerMax
+} NSDragOperation;
+
+typedef enum NSComparisonResult : NSInteger {
+    NSOrderedAscending = -1L,
+    NSOrderedSame,
+    NSOrderedDescending
+} NSComparisonResult;
+'''
+
+try:
+    import clang.cindex
+    has_clang = True
+except ImportError:
+    has_clang = False
+
+
+# the script is written for Python 2
+@unittest.skipUnless(has_clang and sys.version_info[0] == 2, 'needs Python 2 with the libclang bindings')
+class EnumConstantsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        header = os.path.join(self.dir, 'Enums.h')
+        with open(header, 'w') as f:
+            f.write(HEADER)
+        self.source = subprocess.check_output([sys.executable, SCRIPT, header])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unsigned_max(self):
+        self.assertTrue('  NSDragOperationEvery C.NSDragOperation = 18446744073709551615\n' in self.source)
+        self.assertTrue('  NSDragOperationNone C.NSDragOperation = 0\n' in self.source)
+
+    def test_signed(self):
+        self.assertTrue('  NSOrderedAscending C.NSComparisonResult = -1\n' in self.source)
+        self.assertTrue('  NSOrderedDescending C.NSComparisonResult = 1\n' in self.source)
+
+
+if __name__ == '__main__':
+    unittest.main()